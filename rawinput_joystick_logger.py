@@ -1,27 +1,55 @@
 import argparse
+import binascii
 import csv
 import ctypes
 from ctypes import wintypes
 import json
+import queue
 import sys
+import threading
 import time
+import traceback
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 import win32api
 import win32con
 import win32gui
 
 
-user32 = ctypes.windll.user32
+user32 = ctypes.WinDLL("user32", use_last_error=True)
 hid = ctypes.windll.hid
+kernel32 = ctypes.windll.kernel32
 
 HRAWINPUT = wintypes.HANDLE
 
 WM_INPUT = 0x00FF
+WM_INPUT_DEVICE_CHANGE = 0x00FE
+GIDC_ARRIVAL = 1
+GIDC_REMOVAL = 2
 RID_INPUT = 0x10000003
+RIDEV_PAGEONLY = 0x00000020
 RIDEV_INPUTSINK = 0x00000100
+RIDEV_DEVNOTIFY = 0x00002000
 RIM_TYPEHID = 2
+ERROR_INVALID_HANDLE = 6
+ERROR_INSUFFICIENT_BUFFER = 122
+
+RAW_INPUT_BUFFER_SIZE = 16384
+RAW_INPUT_ALIGN = ctypes.sizeof(ctypes.c_void_p)
+
+EVENT_QUEUE_SIZE = 4096
+CONSUMER_SHUTDOWN_TIMEOUT = 5.0
+
+WRITE_BUFFER_SIZE = 1 << 20
+FLUSH_EVERY_EVENTS = 256
+
+CSV_LINE_TEMPLATE = "%s,%d,%s,%s,%s,%s,%d,%s,%s,%s\r\n"
 
 HIDP_STATUS_SUCCESS = 0x00110000
 HIDP_REPORT_TYPE_INPUT = 0
@@ -52,6 +80,10 @@ AXIS_USAGE_NAMES = {
     USAGE_HAT: "hat",
 }
 
+_AXIS_NAME_TABLE: Tuple[Optional[str], ...] = tuple(
+    AXIS_USAGE_NAMES.get(usage) for usage in range(0x40)
+)
+
 
 class RAWINPUTDEVICELIST(ctypes.Structure):
     _fields_ = [
@@ -240,13 +272,79 @@ class HIDP_VALUE_CAPS(ctypes.Structure):
     ]
 
 
+user32.GetRawInputData.argtypes = [
+    HRAWINPUT,
+    wintypes.UINT,
+    ctypes.c_void_p,
+    ctypes.POINTER(wintypes.UINT),
+    wintypes.UINT,
+]
+user32.GetRawInputData.restype = wintypes.UINT
+
+user32.GetRawInputBuffer.argtypes = [
+    ctypes.c_void_p,
+    ctypes.POINTER(wintypes.UINT),
+    wintypes.UINT,
+]
+user32.GetRawInputBuffer.restype = wintypes.UINT
+
+hid.HidP_GetUsageValue.argtypes = [
+    ctypes.c_int,
+    wintypes.USHORT,
+    wintypes.USHORT,
+    wintypes.USHORT,
+    ctypes.POINTER(wintypes.ULONG),
+    ctypes.c_void_p,
+    ctypes.c_char_p,
+    wintypes.ULONG,
+]
+hid.HidP_GetUsageValue.restype = wintypes.LONG
+
+hid.HidP_GetUsages.argtypes = [
+    ctypes.c_int,
+    wintypes.USHORT,
+    wintypes.USHORT,
+    ctypes.POINTER(wintypes.USHORT),
+    ctypes.POINTER(wintypes.ULONG),
+    ctypes.c_void_p,
+    ctypes.c_char_p,
+    wintypes.ULONG,
+]
+hid.HidP_GetUsages.restype = wintypes.LONG
+
+
+def is_wow64_process() -> bool:
+    if ctypes.sizeof(ctypes.c_void_p) != 4:
+        return False
+    result = wintypes.BOOL(False)
+    if not kernel32.IsWow64Process(kernel32.GetCurrentProcess(), ctypes.byref(result)):
+        return False
+    return bool(result.value)
+
+
+def raw_input_align(size: int) -> int:
+    return (size + RAW_INPUT_ALIGN - 1) & ~(RAW_INPUT_ALIGN - 1)
+
+
+def json_dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def json_dumps_str(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
 def _check_hidp(status: int, label: str) -> bool:
     if status != HIDP_STATUS_SUCCESS:
         return False
     return True
 
 
-def get_raw_input_device_list() -> List[RAWINPUTDEVICELIST]:
+def get_raw_input_device_list() -> Tuple[ctypes.Array, int]:
     device_count = wintypes.UINT(0)
     res = user32.GetRawInputDeviceList(
         None,
@@ -254,9 +352,9 @@ def get_raw_input_device_list() -> List[RAWINPUTDEVICELIST]:
         ctypes.sizeof(RAWINPUTDEVICELIST),
     )
     if res != 0:
-        raise ctypes.WinError()
+        raise ctypes.WinError(ctypes.get_last_error())
     if device_count.value == 0:
-        return []
+        return (RAWINPUTDEVICELIST * 0)(), 0
     array_type = RAWINPUTDEVICELIST * device_count.value
     device_list = array_type()
     res = user32.GetRawInputDeviceList(
@@ -265,8 +363,8 @@ def get_raw_input_device_list() -> List[RAWINPUTDEVICELIST]:
         ctypes.sizeof(RAWINPUTDEVICELIST),
     )
     if res == wintypes.UINT(-1).value:
-        raise ctypes.WinError()
-    return list(device_list)
+        raise ctypes.WinError(ctypes.get_last_error())
+    return device_list, int(res)
 
 
 def get_device_name(handle: wintypes.HANDLE) -> str:
@@ -315,7 +413,7 @@ def get_preparsed_data(handle: wintypes.HANDLE) -> Optional[ctypes.Array]:
 
 def parse_hid_caps(
     preparsed: ctypes.Array,
-) -> Optional[Tuple[HIDP_CAPS, List[HIDP_VALUE_CAPS], List[HIDP_BUTTON_CAPS]]]:
+) -> Optional[Tuple[HIDP_CAPS, ctypes.Array, int, ctypes.Array, int]]:
     caps = HIDP_CAPS()
     status = hid.HidP_GetCaps(preparsed, ctypes.byref(caps))
     if not _check_hidp(status, "HidP_GetCaps"):
@@ -334,9 +432,7 @@ def parse_hid_caps(
         preparsed,
     )
     if not _check_hidp(status, "HidP_GetValueCaps"):
-        value_caps = []
-    else:
-        value_caps = list(value_caps)[: value_caps_count.value]
+        value_caps_count.value = 0
 
     status = hid.HidP_GetButtonCaps(
         HIDP_REPORT_TYPE_INPUT,
@@ -345,39 +441,98 @@ def parse_hid_caps(
         preparsed,
     )
     if not _check_hidp(status, "HidP_GetButtonCaps"):
-        button_caps = []
-    else:
-        button_caps = list(button_caps)[: button_caps_count.value]
+        button_caps_count.value = 0
 
-    return caps, value_caps, button_caps
+    return (
+        caps,
+        value_caps,
+        value_caps_count.value,
+        button_caps,
+        button_caps_count.value,
+    )
 
 
-def normalize_value(value: int, logical_min: int, logical_max: int) -> Optional[float]:
+def normalize_coefficients(
+    logical_min: int, logical_max: int
+) -> Optional[Tuple[float, float]]:
+    # Signed ranges map to [-1, 1], unsigned ones to [0, 1]: norm = raw * scale + bias.
     if logical_max == logical_min:
         return None
     span = float(logical_max - logical_min)
     if logical_min < 0:
-        return ((value - logical_min) / span) * 2.0 - 1.0
-    return (value - logical_min) / span
+        return 2.0 / span, -2.0 * logical_min / span - 1.0
+    return 1.0 / span, -logical_min / span
+
+
+AxisPlan = List[Tuple[int, int, int, int, str, float, float]]
+ButtonPlan = List[Tuple[int, int, ctypes.Array]]
+
+
+def build_axis_plan(value_caps: ctypes.Array, count: int) -> AxisPlan:
+    plan: AxisPlan = []
+    for i in range(count):
+        cap = value_caps[i]
+        usage_page = int(cap.UsagePage)
+        if usage_page != USAGE_PAGE_GENERIC_DESKTOP:
+            continue
+        if cap.IsRange:
+            usage_min = int(cap.u.Range.UsageMin)
+            usage_max = int(cap.u.Range.UsageMax)
+        else:
+            usage_min = usage_max = int(cap.u.NotRange.Usage)
+        logical_min = int(cap.LogicalMin)
+        logical_max = int(cap.LogicalMax)
+        coefficients = normalize_coefficients(logical_min, logical_max)
+        if coefficients is None:
+            continue
+        scale, bias = coefficients
+        for usage in range(usage_min, usage_max + 1):
+            name = _AXIS_NAME_TABLE[usage] if usage < 0x40 else None
+            if name is None:
+                continue
+            plan.append(
+                (usage_page, usage, logical_min, logical_max, name, scale, bias)
+            )
+    return plan
+
+
+def build_button_plan(button_caps: ctypes.Array, count: int) -> ButtonPlan:
+    plan: ButtonPlan = []
+    for i in range(count):
+        cap = button_caps[i]
+        if cap.IsRange:
+            max_usages = int(cap.u.Range.UsageMax) - int(cap.u.Range.UsageMin) + 1
+        else:
+            max_usages = 1
+        if max_usages <= 0:
+            continue
+        plan.append(
+            (
+                int(cap.UsagePage),
+                int(cap.LinkCollection),
+                (wintypes.USHORT * max_usages)(),
+            )
+        )
+    return plan
 
 
 def hid_get_usage_value(
     preparsed: ctypes.Array,
-    report_buf: ctypes.Array,
+    report_ptr: ctypes.c_char_p,
     report_len: int,
     usage_page: int,
     usage: int,
+    value: wintypes.ULONG,
 ) -> Optional[int]:
-    value = wintypes.ULONG(0)
     status = hid.HidP_GetUsageValue(
         HIDP_REPORT_TYPE_INPUT,
-        wintypes.USHORT(usage_page),
+        usage_page,
         0,
-        wintypes.USHORT(usage),
+        usage,
         ctypes.byref(value),
         preparsed,
-        ctypes.cast(report_buf, ctypes.c_char_p),
-        wintypes.ULONG(report_len),
+        report_ptr,
+        report_len,
     )
     if not _check_hidp(status, "HidP_GetUsageValue"):
         return None
@@ -386,111 +541,127 @@ def hid_get_usage_value(
 
 def hid_get_usages(
     preparsed: ctypes.Array,
-    report_buf: ctypes.Array,
+    report_ptr: ctypes.c_char_p,
     report_len: int,
     usage_page: int,
     link_collection: int,
-    max_usages: int,
-) -> List[int]:
-    usages = (wintypes.USHORT * max_usages)()
-    usage_count = wintypes.ULONG(max_usages)
+    usages: ctypes.Array,
+) -> int:
+    usage_count = wintypes.ULONG(len(usages))
     status = hid.HidP_GetUsages(
         HIDP_REPORT_TYPE_INPUT,
-        wintypes.USHORT(usage_page),
-        wintypes.USHORT(link_collection),
+        usage_page,
+        link_collection,
         usages,
         ctypes.byref(usage_count),
         preparsed,
-        ctypes.cast(report_buf, ctypes.c_char_p),
-        wintypes.ULONG(report_len),
+        report_ptr,
+        report_len,
     )
     if not _check_hidp(status, "HidP_GetUsages"):
-        return []
-    return [int(usages[i]) for i in range(usage_count.value)]
+        return 0
+    return usage_count.value
 
 
 def decode_hid_report(
-    report: bytes,
+    report: memoryview,
     preparsed: ctypes.Array,
-    value_caps: List[HIDP_VALUE_CAPS],
-    button_caps: List[HIDP_BUTTON_CAPS],
+    axis_plan: AxisPlan,
+    button_plan: ButtonPlan,
+    value: wintypes.ULONG,
+    report_view: memoryview,
+    report_ptr: ctypes.c_char_p,
 ) -> Tuple[Dict[str, Dict[str, Any]], List[int]]:
     # Add device-specific decoding here if you want richer mappings later.
     axes: Dict[str, Dict[str, Any]] = {}
     buttons: List[int] = []
-    report_buf = ctypes.create_string_buffer(report, len(report))
-
-    for cap in value_caps:
-        usage_page = int(cap.UsagePage)
-        if usage_page != USAGE_PAGE_GENERIC_DESKTOP:
-            continue
-
-        usages: List[int] = []
-        if cap.IsRange:
-            usages = list(
-                range(int(cap.u.Range.UsageMin), int(cap.u.Range.UsageMax) + 1)
-            )
-        else:
-            usages = [int(cap.u.NotRange.Usage)]
-
-        for usage in usages:
-            if usage not in AXIS_USAGE_NAMES:
-                continue
-            value = hid_get_usage_value(
-                preparsed, report_buf, len(report), usage_page, usage
-            )
-            if value is None:
-                continue
-            norm = normalize_value(value, int(cap.LogicalMin), int(cap.LogicalMax))
-            axes[AXIS_USAGE_NAMES[usage]] = {
-                "raw": value,
-                "norm": norm,
-                "min": int(cap.LogicalMin),
-                "max": int(cap.LogicalMax),
-            }
+    report_len = len(report)
+    if report_len > len(report_view):
+        report_buf = ctypes.create_string_buffer(bytes(report), report_len)
+        report_ptr = ctypes.c_char_p(ctypes.addressof(report_buf))
+    else:
+        report_view[:report_len] = report
 
-    for cap in button_caps:
-        usage_page = int(cap.UsagePage)
-        max_usages = 0
-        link = int(cap.LinkCollection)
-        if cap.IsRange:
-            max_usages = int(cap.u.Range.UsageMax) - int(cap.u.Range.UsageMin) + 1
-        else:
-            max_usages = 1
-        if max_usages <= 0:
+    for usage_page, usage, logical_min, logical_max, name, scale, bias in axis_plan:
+        raw = hid_get_usage_value(
+            preparsed, report_ptr, report_len, usage_page, usage, value
+        )
+        if raw is None:
             continue
-        pressed = hid_get_usages(
-            preparsed, report_buf, len(report), usage_page, link, max_usages
+        axes[name] = {
+            "raw": raw,
+            "norm": raw * scale + bias,
+            "min": logical_min,
+            "max": logical_max,
+        }
+
+    # Pressed usages accumulate into a bitset, which dedupes and orders them.
+    mask = 0
+    for usage_page, link, usages in button_plan:
+        count = hid_get_usages(
+            preparsed, report_ptr, report_len, usage_page, link, usages
         )
-        buttons.extend(pressed)
+        for i in range(count):
+            mask |= 1 << usages[i]
 
-    buttons = sorted(set(buttons))
+    while mask:
+        low = mask & -mask
+        buttons.append(low.bit_length() - 1)
+        mask ^= low
     return axes, buttons
 
 
-def parse_report_bytes(data: bytes, report_size: int, count: int) -> List[bytes]:
-    reports = []
-    for idx in range(count):
-        start = idx * report_size
-        end = start + report_size
-        if end <= len(data):
-            reports.append(data[start:end])
-    return reports
+def parse_report_bytes(data: bytes, report_size: int, count: int) -> List[memoryview]:
+    if report_size <= 0:
+        return []
+    view = memoryview(data)
+    count = min(count, len(data) // report_size)
+    if count == 1 and len(data) == report_size:
+        return [view]
+    return [
+        view[start : start + report_size]
+        for start in range(0, count * report_size, report_size)
+    ]
 
 
 class DeviceState:
-    def __init__(self, handle: wintypes.HANDLE):
+    def __init__(
+        self,
+        handle: wintypes.HANDLE,
+        name: Optional[str] = None,
+        info: Optional[RID_DEVICE_INFO] = None,
+    ):
         self.handle = handle
-        self.name = get_device_name(handle)
-        self.info = get_device_info(handle)
+        self.handle_value = int(ctypes.cast(handle, ctypes.c_void_p).value or 0)
+        self.handle_str = hex(self.handle_value)
+        self.last_report: memoryview = memoryview(b"")
+        self.name = name if name is not None else get_device_name(handle)
+        self.info = info if info is not None else get_device_info(handle)
         self.preparsed = get_preparsed_data(handle)
         self.caps: Optional[HIDP_CAPS] = None
-        self.value_caps: List[HIDP_VALUE_CAPS] = []
-        self.button_caps: List[HIDP_BUTTON_CAPS] = []
+        self.value_caps: ctypes.Array = (HIDP_VALUE_CAPS * 0)()
+        self.value_caps_count = 0
+        self.button_caps: ctypes.Array = (HIDP_BUTTON_CAPS * 0)()
+        self.button_caps_count = 0
         if self.preparsed is not None:
             parsed = parse_hid_caps(self.preparsed)
             if parsed is not None:
-                self.caps, self.value_caps, self.button_caps = parsed
+                (
+                    self.caps,
+                    self.value_caps,
+                    self.value_caps_count,
+                    self.button_caps,
+                    self.button_caps_count,
+                ) = parsed
+        self.axis_plan = build_axis_plan(self.value_caps, self.value_caps_count)
+        self.button_plan = build_button_plan(self.button_caps, self.button_caps_count)
+        self.value_out = wintypes.ULONG(0)
+        report_len = 0
+        if self.caps is not None:
+            report_len = int(self.caps.InputReportByteLength)
+        self.report_buf = (ctypes.c_ubyte * max(report_len, 256))()
+        self.report_view = memoryview(self.report_buf).cast("B")
+        self.report_ptr = ctypes.cast(self.report_buf, ctypes.c_char_p)
 
     @property
     def usage_page(self) -> Optional[int]:
@@ -505,13 +676,28 @@ class DeviceState:
         return int(self.info.u.hid.usUsage)
 
 
+def csv_quote(value: str) -> str:
+    # Same output as csv.QUOTE_MINIMAL with the default dialect.
+    if '"' in value:
+        return '"' + value.replace('"', '""') + '"'
+    if "," in value or "\n" in value or "\r" in value:
+        return '"' + value + '"'
+    return value
+
+
 class EventWriter:
-    def __init__(self, path: str, fmt: str):
+    def __init__(self, path: str, fmt: str, safe_csv: bool = False):
         self.path = path
         self.fmt = fmt
-        self.file = open(path, "w", newline="", encoding="utf-8")
         self.csv_writer: Optional[csv.DictWriter] = None
-        if fmt == "csv":
+        self._quoted_names: Dict[str, str] = {}
+        self._pending = 0
+        if fmt == "jsonl":
+            self.file = open(path, "wb", buffering=WRITE_BUFFER_SIZE)
+        else:
+            self.file = open(
+                path, "w", newline="", encoding="utf-8", buffering=WRITE_BUFFER_SIZE
+            )
             fieldnames = [
                 "timestamp_iso",
                 "timestamp_ms",
@@ -524,16 +710,44 @@ class EventWriter:
                 "axes_json",
                 "buttons_json",
             ]
-            self.csv_writer = csv.DictWriter(self.file, fieldnames=fieldnames)
-            self.csv_writer.writeheader()
+            if safe_csv:
+                self.csv_writer = csv.DictWriter(self.file, fieldnames=fieldnames)
+                self.csv_writer.writeheader()
+            else:
+                self.file.write(",".join(fieldnames) + "\r\n")
 
     def write_event(self, row: Dict[str, Any]) -> None:
         if self.fmt == "jsonl":
-            self.file.write(json.dumps(row, separators=(",", ":")) + "\n")
-        else:
-            if self.csv_writer is None:
-                return
+            self.file.write(json_dumps(row))
+            self.file.write(b"\n")
+        elif self.csv_writer is not None:
             self.csv_writer.writerow(row)
+        else:
+            name = row["device_name"]
+            quoted_name = self._quoted_names.get(name)
+            if quoted_name is None:
+                quoted_name = self._quoted_names[name] = csv_quote(name)
+            usage_page = row["usage_page"]
+            usage = row["usage"]
+            self.file.write(
+                CSV_LINE_TEMPLATE
+                % (
+                    row["timestamp_iso"],
+                    row["timestamp_ms"],
+                    row["device_handle"],
+                    quoted_name,
+                    "" if usage_page is None else usage_page,
+                    "" if usage is None else usage,
+                    row["report_size"],
+                    row["report_hex"],
+                    csv_quote(row["axes_json"]),
+                    csv_quote(row["buttons_json"]),
+                )
+            )
+        self._pending += 1
+        if self._pending >= FLUSH_EVERY_EVENTS:
+            self.file.flush()
+            self._pending = 0
 
     def close(self) -> None:
         try:
@@ -543,38 +757,146 @@ class EventWriter:
 
 
 class RawInputLogger:
-    def __init__(self, writer: EventWriter, device_filter: Optional[str], echo: bool):
+    def __init__(
+        self,
+        writer: EventWriter,
+        device_filter: Optional[str],
+        echo: bool,
+        include_report: bool = False,
+        coalesce: bool = False,
+    ):
         self.writer = writer
         self.device_filter = device_filter.lower() if device_filter else None
         self.device_cache: Dict[int, DeviceState] = {}
         self.echo = echo
+        self.include_report = include_report
+        self.coalesce = coalesce
+        self.coalesced_events = 0
+        self.allowed_handles: Set[int] = set()
+        self.refresh_devices()
+        self.raw_buffer = (ctypes.c_ubyte * RAW_INPUT_BUFFER_SIZE)()
+        # Under WOW64, GetRawInputBuffer returns blocks in the 64-bit layout (24-byte
+        # header, QWORD alignment); rather than re-deriving offsets, batch reads are
+        # disabled there and every message goes through GetRawInputData.
+        self.batch_reads = not is_wow64_process()
+        self._last_ms = -1
+        self._last_iso = ""
+        self._iso_second = -1
+        self._iso_prefix = ""
+        self.events: queue.Queue = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.dropped_events = 0
+        self.failed_events = 0
+        self._consumer = threading.Thread(target=self._drain_events, daemon=True)
+        self._consumer.start()
+
+    def close(self) -> None:
+        if not self._consumer.is_alive():
+            return
+        try:
+            self.events.put(None, timeout=CONSUMER_SHUTDOWN_TIMEOUT)
+        except queue.Full:
+            print("Event consumer did not drain the queue; remaining events are lost.")
+            return
+        self._consumer.join(CONSUMER_SHUTDOWN_TIMEOUT)
+
+    def _drain_events(self) -> None:
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            try:
+                self.process_event(*event)
+            except Exception:
+                self.failed_events += 1
+                if self.failed_events == 1:
+                    traceback.print_exc()
 
     def _match_filter(self, name: str) -> bool:
         if not self.device_filter:
             return True
         return self.device_filter in name.lower()
 
-    def get_device_state(self, handle: wintypes.HANDLE) -> Optional[DeviceState]:
-        handle_value = int(ctypes.cast(handle, ctypes.c_void_p).value or 0)
-        if handle_value in self.device_cache:
-            return self.device_cache[handle_value]
-        state = DeviceState(handle)
-        if not self._match_filter(state.name):
-            return None
-        self.device_cache[handle_value] = state
-        return state
+    def refresh_devices(self) -> None:
+        devices, count = get_raw_input_device_list()
+        for i in range(count):
+            entry = devices[i]
+            if entry.dwType != RIM_TYPEHID:
+                continue
+            self.add_device(entry.hDevice or 0)
+
+    def add_device(self, handle_value: int) -> None:
+        if handle_value in self.allowed_handles:
+            return
+        handle = wintypes.HANDLE(handle_value)
+        info = get_device_info(handle)
+        if info is None or info.dwType != RIM_TYPEHID:
+            return
+        name = get_device_name(handle)
+        if not self._match_filter(name):
+            return
+        self.device_cache[handle_value] = DeviceState(handle, name, info)
+        self.allowed_handles.add(handle_value)
+
+    def remove_device(self, handle_value: int) -> None:
+        self.allowed_handles.discard(handle_value)
+        self.device_cache.pop(handle_value, None)
+
+    def handle_device_change(self, wparam: int, lparam: int) -> None:
+        if wparam == GIDC_ARRIVAL:
+            self.add_device(lparam)
+        elif wparam == GIDC_REMOVAL:
+            self.remove_device(lparam)
+
+    def format_timestamp_iso(self, ts_ms: int) -> str:
+        if ts_ms == self._last_ms:
+            return self._last_iso
+        seconds, millis = divmod(ts_ms, 1000)
+        if seconds != self._iso_second:
+            self._iso_second = seconds
+            self._iso_prefix = datetime.fromtimestamp(seconds, tz=timezone.utc).strftime(
+                "%Y-%m-%dT%H:%M:%S"
+            )
+        self._last_ms = ts_ms
+        self._last_iso = f"{self._iso_prefix}.{millis:03d}000+00:00"
+        return self._last_iso
+
+    def get_device_state(self, handle_value: int) -> Optional[DeviceState]:
+        # Devices are cached on arrival; a miss means it was filtered out or removed.
+        return self.device_cache.get(handle_value)
 
     def handle_wm_input(self, lparam: int) -> None:
+        buffer = self.read_raw_input(lparam)
+        if buffer is not None:
+            self.handle_raw_input(buffer, 0)
+        if self.batch_reads:
+            self.drain_raw_input_buffer()
+
+    def read_raw_input(self, lparam: int) -> Optional[ctypes.Array]:
+        header_size = ctypes.sizeof(RAWINPUTHEADER)
+        data_size = wintypes.UINT(len(self.raw_buffer))
+        res = user32.GetRawInputData(
+            HRAWINPUT(lparam),
+            RID_INPUT,
+            self.raw_buffer,
+            ctypes.byref(data_size),
+            header_size,
+        )
+        if res != wintypes.UINT(-1).value:
+            return self.raw_buffer
+        if ctypes.get_last_error() != ERROR_INSUFFICIENT_BUFFER:
+            return None
+
+        # Larger than the reusable buffer: fall back to size query + fetch.
         data_size = wintypes.UINT(0)
         res = user32.GetRawInputData(
             HRAWINPUT(lparam),
             RID_INPUT,
             None,
             ctypes.byref(data_size),
-            ctypes.sizeof(RAWINPUTHEADER),
+            header_size,
         )
         if res == wintypes.UINT(-1).value or data_size.value == 0:
-            return
+            return None
 
         buffer = (ctypes.c_ubyte * data_size.value)()
         res = user32.GetRawInputData(
@@ -582,40 +904,99 @@ class RawInputLogger:
             RID_INPUT,
             buffer,
             ctypes.byref(data_size),
-            ctypes.sizeof(RAWINPUTHEADER),
+            header_size,
         )
         if res == wintypes.UINT(-1).value:
-            return
+            return None
+        return buffer
 
-        header = RAWINPUTHEADER.from_buffer_copy(buffer)
-        if header.dwType != RIM_TYPEHID:
+    def drain_raw_input_buffer(self) -> None:
+        header_size = ctypes.sizeof(RAWINPUTHEADER)
+        data_size = wintypes.UINT(0)
+        res = user32.GetRawInputBuffer(None, ctypes.byref(data_size), header_size)
+        if res == wintypes.UINT(-1).value:
+            if ctypes.get_last_error() == ERROR_INVALID_HANDLE:
+                self.batch_reads = False
+            return
+        if data_size.value == 0:
             return
+        if data_size.value > len(self.raw_buffer):
+            self.raw_buffer = (ctypes.c_ubyte * raw_input_align(data_size.value))()
 
-        rahid_offset = ctypes.sizeof(RAWINPUTHEADER)
-        rahid = RAWHID.from_buffer_copy(buffer, rahid_offset)
+        while True:
+            data_size = wintypes.UINT(len(self.raw_buffer))
+            count = user32.GetRawInputBuffer(
+                self.raw_buffer, ctypes.byref(data_size), header_size
+            )
+            if count == wintypes.UINT(-1).value:
+                if ctypes.get_last_error() == ERROR_INVALID_HANDLE:
+                    self.batch_reads = False
+                return
+            if count == 0:
+                return
+            offset = 0
+            for _ in range(count):
+                header = self.handle_raw_input(self.raw_buffer, offset)
+                offset += raw_input_align(header.dwSize)
+
+    def handle_raw_input(self, buffer: ctypes.Array, offset: int) -> RAWINPUTHEADER:
+        header = RAWINPUTHEADER.from_buffer(buffer, offset)
+        if header.dwType != RIM_TYPEHID:
+            return header
+        handle_value = header.hDevice or 0
+        if handle_value not in self.allowed_handles:
+            return header
+
+        rahid_offset = offset + ctypes.sizeof(RAWINPUTHEADER)
+        block_end = min(len(buffer), offset + header.dwSize)
+        if rahid_offset + ctypes.sizeof(RAWHID) > len(buffer):
+            return header
+        rahid = RAWHID.from_buffer(buffer, rahid_offset)
         data_offset = rahid_offset + 8
-        raw_bytes = bytes(buffer[data_offset : data_offset + rahid.dwSizeHid * rahid.dwCount])
-        reports = parse_report_bytes(raw_bytes, int(rahid.dwSizeHid), int(rahid.dwCount))
+        data_len = rahid.dwSizeHid * rahid.dwCount
+        if data_offset + data_len > block_end:
+            return header
+        # One copy out of the reusable input buffer; reports are views into it from here on.
+        raw_bytes = ctypes.string_at(ctypes.addressof(buffer) + data_offset, data_len)
+        ts_ms = time.time_ns() // 1_000_000
+        try:
+            self.events.put_nowait(
+                (ts_ms, handle_value, raw_bytes, int(rahid.dwSizeHid), int(rahid.dwCount))
+            )
+        except queue.Full:
+            self.dropped_events += 1
+        return header
 
-        device_state = self.get_device_state(header.hDevice)
+    def process_event(
+        self, ts_ms: int, handle_value: int, raw_bytes: bytes, report_size: int, count: int
+    ) -> None:
+        reports = parse_report_bytes(raw_bytes, report_size, count)
+
+        device_state = self.get_device_state(handle_value)
         if device_state is None:
             return
 
-        timestamp = time.time()
-        ts_iso = datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
-        ts_ms = int(timestamp * 1000)
-        device_handle_str = hex(int(ctypes.cast(header.hDevice, ctypes.c_void_p).value or 0))
+        ts_iso = self.format_timestamp_iso(ts_ms)
+        device_handle_str = device_state.handle_str
 
         for report in reports:
+            if self.coalesce:
+                if report == device_state.last_report:
+                    self.coalesced_events += 1
+                    continue
+                device_state.last_report = report
             axes: Dict[str, Dict[str, Any]] = {}
             buttons: List[int] = []
-            if device_state.preparsed is not None and device_state.value_caps:
+            if device_state.preparsed is not None and device_state.value_caps_count:
                 try:
                     axes, buttons = decode_hid_report(
                         report,
                         device_state.preparsed,
-                        device_state.value_caps,
-                        device_state.button_caps,
+                        device_state.axis_plan,
+                        device_state.button_plan,
+                        device_state.value_out,
+                        device_state.report_view,
+                        device_state.report_ptr,
                     )
                 except Exception:
                     axes = {}
@@ -629,10 +1010,16 @@ class RawInputLogger:
                 "usage_page": device_state.usage_page,
                 "usage": device_state.usage,
                 "report_size": len(report),
-                "report_hex": report.hex(),
-                "axes_json": json.dumps(axes, separators=(",", ":")),
-                "buttons_json": json.dumps(buttons, separators=(",", ":")),
             }
+            if self.writer.fmt == "csv":
+                row["report_hex"] = report.hex() if self.include_report else ""
+                row["axes_json"] = json_dumps_str(axes)
+                row["buttons_json"] = json_dumps_str(buttons)
+            else:
+                if self.include_report:
+                    row["report_b64"] = binascii.b2a_base64(report, newline=False).decode()
+                row["axes"] = axes
+                row["buttons"] = buttons
             self.writer.write_event(row)
             if self.echo:
                 axes_summary = {
@@ -645,12 +1032,13 @@ class RawInputLogger:
 
 
 def list_devices() -> None:
-    devices = get_raw_input_device_list()
-    if not devices:
+    devices, count = get_raw_input_device_list()
+    if count == 0:
         print("No raw input devices found.")
         return
     print("Raw input devices:")
-    for entry in devices:
+    for i in range(count):
+        entry = devices[i]
         name = get_device_name(entry.hDevice)
         info = get_device_info(entry.hDevice)
         usage_page = None
@@ -665,19 +1053,32 @@ def list_devices() -> None:
         )
 
 
-def register_raw_input(hwnd: int) -> None:
-    devices = (RAWINPUTDEVICE * 2)()
-    devices[0].usUsagePage = USAGE_PAGE_GENERIC_DESKTOP
-    devices[0].usUsage = 0x04
-    devices[0].dwFlags = RIDEV_INPUTSINK
-    devices[0].hwndTarget = hwnd
-    devices[1].usUsagePage = USAGE_PAGE_GENERIC_DESKTOP
-    devices[1].usUsage = 0x05
-    devices[1].dwFlags = RIDEV_INPUTSINK
-    devices[1].hwndTarget = hwnd
+def register_raw_input(hwnd: int, page_only: bool = False) -> None:
+    flags = RIDEV_INPUTSINK | RIDEV_DEVNOTIFY
 
-    if not user32.RegisterRawInputDevices(devices, 2, ctypes.sizeof(RAWINPUTDEVICE)):
-        raise ctypes.WinError()
+    if page_only:
+        # Every generic desktop collection, including mouse and keyboard; non-HID
+        # input is discarded by the dwType check in handle_raw_input.
+        devices = (RAWINPUTDEVICE * 1)()
+        devices[0].usUsagePage = USAGE_PAGE_GENERIC_DESKTOP
+        devices[0].usUsage = 0
+        devices[0].dwFlags = flags | RIDEV_PAGEONLY
+        devices[0].hwndTarget = hwnd
+    else:
+        devices = (RAWINPUTDEVICE * 2)()
+        devices[0].usUsagePage = USAGE_PAGE_GENERIC_DESKTOP
+        devices[0].usUsage = 0x04
+        devices[0].dwFlags = flags
+        devices[0].hwndTarget = hwnd
+        devices[1].usUsagePage = USAGE_PAGE_GENERIC_DESKTOP
+        devices[1].usUsage = 0x05
+        devices[1].dwFlags = flags
+        devices[1].hwndTarget = hwnd
+
+    if not user32.RegisterRawInputDevices(
+        devices, len(devices), ctypes.sizeof(RAWINPUTDEVICE)
+    ):
+        raise ctypes.WinError(ctypes.get_last_error())
 
 
 def create_message_window(wnd_proc):
@@ -729,24 +1130,65 @@ def main() -> int:
         action="store_true",
         help="Print a short summary of each input event to the console",
     )
+    parser.add_argument(
+        "--hex",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Include the raw HID report (hex for csv, base64 for jsonl)",
+    )
+    parser.add_argument(
+        "--coalesce",
+        action="store_true",
+        help="Skip reports identical to the previous one from the same device",
+    )
+    parser.add_argument(
+        "--safe-csv",
+        action="store_true",
+        help="Write CSV rows through csv.DictWriter instead of the fixed line template",
+    )
+    parser.add_argument(
+        "--page-only",
+        action="store_true",
+        help="Register the whole generic desktop usage page with RIDEV_PAGEONLY",
+    )
     args = parser.parse_args()
 
     list_devices()
 
-    writer = EventWriter(args.out, args.format)
-    logger = RawInputLogger(writer, args.device, args.print)
+    # Let the message pump reclaim the GIL from the consumer thread sooner.
+    sys.setswitchinterval(0.001)
+
+    writer = EventWriter(args.out, args.format, args.safe_csv)
+    logger = RawInputLogger(writer, args.device, args.print, args.hex, args.coalesce)
+
+    def on_device_change(wparam, lparam):
+        logger.handle_device_change(wparam, lparam)
+        return 0
+
+    def on_destroy(wparam, lparam):
+        win32gui.PostQuitMessage(0)
+        return 0
+
+    # Bound as closure locals: wnd_proc runs once per WM_INPUT.
+    wm_input = WM_INPUT
+    handle_wm_input = logger.handle_wm_input
+    def_window_proc = win32gui.DefWindowProc
+    handlers = {
+        WM_INPUT_DEVICE_CHANGE: on_device_change,
+        win32con.WM_DESTROY: on_destroy,
+    }
 
     def wnd_proc(hwnd, msg, wparam, lparam):
-        if msg == WM_INPUT:
-            logger.handle_wm_input(lparam)
-            return 0
-        if msg == win32con.WM_DESTROY:
-            win32gui.PostQuitMessage(0)
+        if msg == wm_input:
+            handle_wm_input(lparam)
             return 0
-        return win32gui.DefWindowProc(hwnd, msg, wparam, lparam)
+        handler = handlers.get(msg)
+        if handler is not None:
+            return handler(wparam, lparam)
+        return def_window_proc(hwnd, msg, wparam, lparam)
 
     hwnd = create_message_window(wnd_proc)
-    register_raw_input(hwnd)
+    register_raw_input(hwnd, args.page_only)
 
     print("Logging WM_INPUT (Ctrl+C to stop).")
     try:
@@ -759,7 +1201,14 @@ def main() -> int:
     except KeyboardInterrupt:
         win32gui.PostQuitMessage(0)
     finally:
+        logger.close()
         writer.close()
+        if logger.dropped_events:
+            print(f"Dropped {logger.dropped_events} events (queue full).")
+        if logger.failed_events:
+            print(f"Failed to process {logger.failed_events} events.")
+        if logger.coalesced_events:
+            print(f"Coalesced {logger.coalesced_events} repeated reports.")
 
     return 0
 